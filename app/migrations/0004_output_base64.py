@@ -0,0 +1,29 @@
+import base64
+
+from django.db import migrations
+
+
+def reencode(apps, encode, decode):
+    Output = apps.get_model("app", "Output")
+    outputs = list(Output.objects.filter(sensitive=True).only("value"))
+    for output in outputs:
+        output.value = encode(decode(output.value)).decode()
+    Output.objects.bulk_update(outputs, ["value"])
+
+
+def b85_to_b64(apps, schema_editor):
+    reencode(apps, base64.b64encode, base64.b85decode)
+
+
+def b64_to_b85(apps, schema_editor):
+    reencode(apps, base64.b85encode, base64.b64decode)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("app", "0003_output_sensitive"),
+    ]
+
+    operations = [
+        migrations.RunPython(b85_to_b64, b64_to_b85),
+    ]
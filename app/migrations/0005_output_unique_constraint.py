@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-15 20:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("app", "0004_output_base64"),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name="output",
+            unique_together=set(),
+        ),
+        migrations.AddConstraint(
+            model_name="output",
+            constraint=models.UniqueConstraint(
+                fields=("stack", "key"), name="unique_output_key"
+            ),
+        ),
+    ]
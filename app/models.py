@@ -1,18 +1,100 @@
-import base64
+import functools
 import json
+import orjson
+import re
 
 from django.conf import settings
 from django.db import models
-from django.db.models import CheckConstraint, F, Q, TextField, Value
-from django.db.models.functions import Concat
+from django.db.models import CheckConstraint, F, Prefetch, Q, UniqueConstraint
 from django.utils.module_loading import import_string
 from django.utils.text import slugify
 
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+
+@functools.lru_cache
+def _load_wrapper(path):
+    return import_string(path)()
+
+
+def get_wrapper():
+    """Return the shared instance of the wrapper configured in settings.WRAPPER."""
+    return _load_wrapper(settings.WRAPPER)
+
+
+# orjson only handles integers that fit in 64 bits, it raises when dumping a
+# larger one and silently turns it into a float when loading it
+_long_int_re = re.compile(rb"\d{19}")
+
+
+def _dumps(value):
+    try:
+        return orjson.dumps(value)
+    except orjson.JSONEncodeError:
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def _loads(plaintext):
+    if _long_int_re.search(plaintext):
+        return json.loads(plaintext)
+    return orjson.loads(plaintext)
+
+
+def encrypt_values(values):
+    """
+    Serialize and encrypt each value, returning the text stored in Output.value.
+
+    The whole batch is handed to the wrapper at once when it implements
+    `encrypt_batch`, so wrappers backed by a remote service can avoid one
+    round-trip per value.
+    """
+    wrapper = get_wrapper()
+    plaintexts = [_dumps(value) for value in values]
+    try:
+        encrypt_batch = wrapper.encrypt_batch
+    except AttributeError:
+        ciphertexts = map(wrapper.encrypt, plaintexts)
+    else:
+        ciphertexts = encrypt_batch(plaintexts)
+    return [base64.b64encode(ciphertext).decode() for ciphertext in ciphertexts]
+
+
+def decrypt_values(values):
+    """
+    Decrypt and deserialize values produced by `encrypt_values()`, using the
+    wrapper's `decrypt_batch` when it has one.
+    """
+    wrapper = get_wrapper()
+    ciphertexts = [base64.b64decode(value) for value in values]
+    try:
+        decrypt_batch = wrapper.decrypt_batch
+    except AttributeError:
+        plaintexts = map(wrapper.decrypt, ciphertexts)
+    else:
+        plaintexts = decrypt_batch(ciphertexts)
+    return [_loads(plaintext) for plaintext in plaintexts]
+
+
+_slug_strip_re = re.compile(r"[^\w\s-]")
+_slug_hyphenate_re = re.compile(r"[-\s]+")
+
+
+def _slugify(value):
+    # Same result as slugify(), without the unicode normalization that ASCII
+    # names do not need
+    if not value.isascii():
+        return slugify(value)
+    value = _slug_strip_re.sub("", value.lower())
+    return _slug_hyphenate_re.sub("-", value).strip("-_")
+
 
 class Model(models.Model):
     def save(self, *args, **kwargs):
-        if not self.id and not self.slug:
-            self.slug = slugify(self.name)
+        if self._state.adding and not self.slug:
+            self.slug = _slugify(self.name)
 
         super().save(*args, **kwargs)
 
@@ -25,15 +107,41 @@ class Project(Model):
     slug = models.SlugField(unique=True, blank=False)
 
 
+_output_fields = ("key", "value", "deprecated", "warning", "sensitive", "stack_id")
+
+# Only the most recent readers of the outputs of a stack are returned
+USED_BY_LIMIT = 50
+_used_by_ordering = ("-last_used_at", "pk")
+
+
 class StackManager(models.Manager):
     def get_queryset(self):
         return (
             super()
             .get_queryset()
-            .annotate(
-                full_path=Concat(
-                    "project__slug", Value("/"), "slug", output_field=TextField()
-                )
+            .select_related("project")
+            .prefetch_related(
+                Prefetch(
+                    "output_set",
+                    queryset=Output.objects.filter(sensitive=False).only(
+                        *_output_fields
+                    ),
+                    to_attr="_plain_outputs",
+                ),
+                Prefetch(
+                    "output_set",
+                    queryset=Output.objects.filter(sensitive=True).only(
+                        *_output_fields
+                    ),
+                    to_attr="_sensitive_outputs",
+                ),
+                Prefetch(
+                    "used_by_rel",
+                    queryset=UsedBy.objects.order_by(*_used_by_ordering)[
+                        :USED_BY_LIMIT
+                    ],
+                    to_attr="_recent_used_by",
+                ),
             )
         )
 
@@ -46,42 +154,51 @@ class Stack(Model):
 
     objects = StackManager()
 
+    @property
+    def full_path(self):
+        return f"{self.project.slug}/{self.slug}"
+
     def outputs(self):
-        wrapper = import_string(settings.WRAPPER)()
+        try:
+            plain, sensitive = self._plain_outputs, self._sensitive_outputs
+        except AttributeError:
+            plain, sensitive = [], []
+            for output in self.output_set.only(*_output_fields):
+                (sensitive if output.sensitive else plain).append(output)
 
-        def decrypt(value, sensitive):
-            if not sensitive:
-                return value
-            return json.loads(wrapper.decrypt(base64.b85decode(value)))
+        values = [output.value for output in plain]
+        if sensitive:
+            values += decrypt_values([output.value for output in sensitive])
 
         return {
-            output.key: {
-                "value": decrypt(output.value, output.sensitive),
-                "deprecated": output.deprecated if output.deprecated else None,
-                "warning": output.warning if output.warning else None,
-                "sensitive": output.sensitive,
-            }
-            for output in self.output_set.all()
+            output.key: output.render(value)
+            for output, value in zip(plain + sensitive, values)
         }
 
+    def recent_used_by(self):
+        try:
+            return self._recent_used_by
+        except AttributeError:
+            return list(self.used_by_rel.order_by(*_used_by_ordering)[:USED_BY_LIMIT])
+
+    def output(self, key):
+        """
+        Same as `outputs()[key]` but only the requested output is fetched.
+        Raises `Output.DoesNotExist` if the stack has no such output.
+        """
+        output = self.output_set.only(*_output_fields).get(key=key)
+        value = output.value
+        if output.sensitive:
+            (value,) = decrypt_values([value])
+        return output.render(value)
+
     class Meta:
         unique_together = [["project", "slug"]]
 
 
 class UsedByManager(models.Manager):
     def get_queryset(self):
-        return (
-            super()
-            .get_queryset()
-            .annotate(
-                full_path=Concat(
-                    "used_by__project__slug",
-                    Value("/"),
-                    "used_by__slug",
-                    output_field=TextField(),
-                )
-            )
-        )
+        return super().get_queryset().select_related("used_by__project")
 
 
 class UsedBy(models.Model):
@@ -93,6 +210,10 @@ class UsedBy(models.Model):
 
     objects = UsedByManager()
 
+    @property
+    def full_path(self):
+        return self.used_by.full_path
+
     class Meta:
         unique_together = [["stack", "used_by"]]
         constraints = [
@@ -111,5 +232,16 @@ class Output(models.Model):
     warning = models.TextField(blank=True)
     sensitive = models.BooleanField(default=False)
 
+    def render(self, value):
+        return {
+            "value": value,
+            "deprecated": self.deprecated or None,
+            "warning": self.warning or None,
+            "sensitive": self.sensitive,
+        }
+
     class Meta:
-        unique_together = [["stack", "key"]]
+        constraints = [
+            # Leads with stack_id, so it also serves the output_set lookups
+            UniqueConstraint(fields=["stack", "key"], name="unique_output_key"),
+        ]
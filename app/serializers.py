@@ -1,11 +1,52 @@
-import base64
-import json
+import functools
+import re
 
-from .models import Output, Project, Stack, UsedBy
-from django.conf import settings
-from django.utils.module_loading import import_string
+from .models import Output, Project, Stack, UsedBy, encrypt_values
+from collections.abc import Mapping
+from django.db import transaction
+from django.urls import get_script_prefix, get_urlconf
 from rest_framework import serializers
-from rest_framework.reverse import reverse
+from rest_framework.exceptions import ValidationError
+from rest_framework.fields import SkipField
+from rest_framework.reverse import preserve_builtin_query_params, reverse
+from rest_framework.settings import api_settings
+
+OUTPUTS_BATCH_SIZE = 500
+
+_slug_re = re.compile(r"[-a-zA-Z0-9_]+")
+
+
+@functools.lru_cache
+def _url_template(view_name, kwarg_names, script_prefix, urlconf):
+    placeholders = {name: f"__{name}__" for name in kwarg_names}
+    url = reverse(view_name, kwargs=placeholders, urlconf=urlconf)
+    url = url.replace("{", "{{").replace("}", "}}")
+    for name, placeholder in placeholders.items():
+        url = url.replace(placeholder, f"{{{name}}}")
+    return url
+
+
+def reverse_url(view_name, kwargs, request):
+    """
+    Same as `reverse()` but the URL pattern is only resolved once per view,
+    the result being used as a template for the next objects.
+
+    Requests using API versioning and unusual lookup values go through
+    `reverse()` instead.
+    """
+    if getattr(request, "versioning_scheme", None) is not None or not all(
+        isinstance(value, str) and _slug_re.fullmatch(value)
+        for value in kwargs.values()
+    ):
+        return reverse(view_name, kwargs=kwargs, request=request)
+
+    template = _url_template(
+        view_name, tuple(sorted(kwargs)), get_script_prefix(), get_urlconf()
+    )
+    url = template.format_map(kwargs)
+    if request is not None:
+        url = request.build_absolute_uri(url)
+    return preserve_builtin_query_params(url, request)
 
 
 class HyperlinkedIdentityField(serializers.HyperlinkedIdentityField):
@@ -26,7 +67,32 @@ class HyperlinkedIdentityField(serializers.HyperlinkedIdentityField):
             kwargs["project"] = obj.project.slug
         except AttributeError:
             pass
-        return self.reverse(view_name, kwargs=kwargs, request=request, format=format)
+        if format:
+            return self.reverse(
+                view_name, kwargs=kwargs, request=request, format=format
+            )
+        return reverse_url(view_name, kwargs, request)
+
+
+@functools.lru_cache
+def _restrict_fields(cls, fields):
+    if fields.issuperset(cls.Meta.fields):
+        return cls
+
+    meta = type(
+        "Meta",
+        (cls.Meta,),
+        {"fields": [name for name in cls.Meta.fields if name in fields]},
+    )
+    restricted = type(cls)(
+        cls.__name__,
+        (cls,),
+        {"Meta": meta, "__module__": cls.__module__, "__qualname__": cls.__qualname__},
+    )
+    restricted._declared_fields = {
+        name: field for name, field in cls._declared_fields.items() if name in fields
+    }
+    return restricted
 
 
 # https://www.django-rest-framework.org/api-guide/serializers/#dynamically-modifying-fields
@@ -34,22 +100,23 @@ class DynamicFieldsModelSerializer(serializers.HyperlinkedModelSerializer):
     """
     A ModelSerializer that takes an additional `fields` argument that
     controls which fields should be displayed.
+
+    Rather than building every field and dropping the extra ones on each
+    instantiation, the serializer is swapped for a cached subclass that only
+    knows about the requested fields.
     """
 
+    def __new__(cls, *args, **kwargs):
+        fields = kwargs.get("fields")
+        if fields is not None:
+            cls = _restrict_fields(cls, frozenset(fields))
+        return super().__new__(cls, *args, **kwargs)
+
     def __init__(self, *args, **kwargs):
         # Don't pass the 'fields' arg up to the superclass
-        fields = kwargs.pop("fields", None)
-
-        # Instantiate the superclass normally
+        kwargs.pop("fields", None)
         super().__init__(*args, **kwargs)
 
-        if fields is not None:
-            # Drop any fields that are not specified in the `fields` argument.
-            allowed = set(fields)
-            existing = set(self.fields)
-            for field_name in existing - allowed:
-                self.fields.pop(field_name)
-
 
 class ProjectSerializerStub(DynamicFieldsModelSerializer):
     id = serializers.CharField(source="slug", read_only=True)
@@ -70,10 +137,10 @@ class UsedBySerializer(serializers.Serializer):
         fields = ["id", "url", "last_used_at"]
 
     def get_url(self, obj):
-        return reverse(
+        return reverse_url(
             "stack-detail",
-            kwargs={"project": obj.used_by.project.slug, "slug": obj.used_by.slug},
-            request=self.context["request"],
+            {"project": obj.used_by.project.slug, "slug": obj.used_by.slug},
+            self.context["request"],
         )
 
 
@@ -84,37 +151,97 @@ class OutputSerializer(serializers.Serializer):
     sensitive = serializers.BooleanField(default=False)
 
 
+class OutputsField(serializers.DictField):
+    """
+    The outputs of a stack, indexed by their key.
+
+    Each output is validated directly against the fields of `OutputSerializer`
+    instead of running the serializer for every key, and outputs are already
+    in their rendered form when read from `Stack.outputs()`.
+    """
+
+    child = OutputSerializer()
+    default_error_messages = {
+        "invalid_key": (
+            'Enter a valid "slug" consisting of letters, numbers, underscores or '
+            "hyphens."
+        ),
+    }
+
+    def run_child_validation(self, data):
+        result = {}
+        errors = {}
+
+        for key, output in data.items():
+            key = str(key)
+            try:
+                if not _slug_re.fullmatch(key):
+                    self.fail("invalid_key")
+                result[key] = self.validate_output(output)
+            except ValidationError as e:
+                errors[key] = e.detail
+
+        if errors:
+            raise ValidationError(errors)
+        return result
+
+    def validate_output(self, output):
+        if not isinstance(output, Mapping):
+            message = self.child.error_messages["invalid"].format(
+                datatype=type(output).__name__
+            )
+            raise ValidationError(
+                {api_settings.NON_FIELD_ERRORS_KEY: [message]}, code="invalid"
+            )
+
+        result = {}
+        errors = {}
+        for field in self.child.fields.values():
+            try:
+                result[field.field_name] = field.run_validation(field.get_value(output))
+            except ValidationError as e:
+                errors[field.field_name] = e.detail
+            except SkipField:
+                pass
+
+        if errors:
+            raise ValidationError(errors)
+        return result
+
+    def to_representation(self, value):
+        return {str(key): output for key, output in value.items()}
+
+
 class StackSerializer(DynamicFieldsModelSerializer):
     id = serializers.CharField(source="full_path", read_only=True)
     url = HyperlinkedIdentityField(view_name="stack-detail", lookup_field="slug")
     project = ProjectSerializerStub(read_only=True)
-    outputs = serializers.DictField(child=OutputSerializer(), default=dict)
-    used_by = UsedBySerializer(source="used_by_rel", many=True, read_only=True)
+    outputs = OutputsField(default=dict)
+    used_by = UsedBySerializer(source="recent_used_by", many=True, read_only=True)
 
+    @transaction.atomic
     def create(self, validated_data):
         outputs = validated_data.pop("outputs")
         stack = Stack.objects.create(**validated_data)
-        wrapper = import_string(settings.WRAPPER)()
 
-        objects = []
-        for k, v in outputs.items():
-            if v["sensitive"]:
-                b = json.dumps(v["value"]).encode()
-                value = base64.b85encode(wrapper.encrypt(b)).decode()
-            else:
-                value = v["value"]
+        values = {k: v["value"] for k, v in outputs.items()}
+        sensitive = [k for k, v in outputs.items() if v["sensitive"]]
+        if sensitive:
+            values.update(zip(sensitive, encrypt_values(values[k] for k in sensitive)))
 
-            objects.append(
+        Output.objects.bulk_create(
+            (
                 Output(
                     stack_id=stack.id,
                     key=k,
-                    value=value,
+                    value=values[k],
                     deprecated=v["deprecated"],
                     sensitive=v["sensitive"],
                 )
-            )
-
-        Output.objects.bulk_create(objects)
+                for k, v in outputs.items()
+            ),
+            batch_size=OUTPUTS_BATCH_SIZE,
+        )
         return stack
 
     class Meta:
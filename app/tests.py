@@ -1,28 +1,31 @@
-from .models import Output, Project, Stack, UsedBy
+import time
+
+from .models import USED_BY_LIMIT, Output, Project, Stack, UsedBy
+from .views import UsedByRecorder
+from datetime import timedelta
 from django.core.exceptions import ValidationError
 from django.db import transaction
-from django.db.utils import IntegrityError
-from django.test import override_settings
+from django.db.utils import DatabaseError, IntegrityError
+from django.test import TransactionTestCase, override_settings
 from django.utils import timezone
 from freezegun import freeze_time
 from rest_framework.test import APITestCase
 from typing import Any
+from unittest import mock
 
 
+@override_settings(USED_BY_FLUSH_INTERVAL=0)
 class TestCase(APITestCase):
     maxDiff = None
-    fixtures = ["sample.yaml"]
+    fixtures = ["sample.json"]
 
     def assertResponse(self, path: str, expected: Any, **kwargs):
         response = self.client.get(path, **kwargs)
         self.assertEqual(response.status_code, 200)
-        self.assertJSONEqual(response.content, expected)
+        self.assertEqual(response.json(), expected)
 
 
 class BasicTest(TestCase):
-    maxDiff = None
-    fixtures = ["sample.yaml"]
-
     def test_consistency(self):
         # Two projects should not have the same slug
         p = Project.objects.create(name="Test", slug="test")
@@ -30,8 +33,12 @@ class BasicTest(TestCase):
             Project.objects.create(name="Test", slug="test")
 
         # Two stacks can only have the same slug if they are in different projects
-        Stack.objects.create(name="test", slug="test", project_id=1)
-        Stack.objects.create(name="test", slug="test", project_id=p.id)
+        Stack.objects.bulk_create(
+            [
+                Stack(name="test", slug="test", project_id=1),
+                Stack(name="test", slug="test", project_id=p.id),
+            ]
+        )
         with transaction.atomic(), self.assertRaises(IntegrityError):
             Stack.objects.create(name="test", slug="test", project_id=p.id)
 
@@ -47,7 +54,9 @@ class BasicTest(TestCase):
             UsedBy.objects.create(stack_id=1, used_by_id=1, last_used_at=timezone.now())
 
         # A dependency can only exist once
-        UsedBy.objects.create(stack_id=1, used_by_id=2, last_used_at=timezone.now())
+        UsedBy.objects.bulk_create(
+            [UsedBy(stack_id=1, used_by_id=2, last_used_at=timezone.now())]
+        )
         with transaction.atomic(), self.assertRaises(IntegrityError):
             UsedBy.objects.create(stack_id=1, used_by_id=2, last_used_at=timezone.now())
 
@@ -57,7 +66,9 @@ class BasicTest(TestCase):
         Output(stack_id=1, key="test", value="test", deprecated=None).clean_fields()
 
         # Outputs must have a unique name in a given stack
-        Output.objects.create(stack_id=1, key="test", value="test", deprecated="")
+        Output.objects.bulk_create(
+            [Output(stack_id=1, key="test", value="test", deprecated="")]
+        )
         with transaction.atomic(), self.assertRaises(IntegrityError):
             Output.objects.create(stack_id=1, key="test", value="test", deprecated="")
 
@@ -70,170 +81,107 @@ class BasicTest(TestCase):
         )
 
 
+BACKEND_PROJECT = {
+    "id": "backend",
+    "name": "Backend",
+    "url": "http://testserver/v1/projects/backend/",
+    "stacks": [
+        {
+            "id": "backend/load-balancers",
+            "name": "Load-Balancers",
+            "url": "http://testserver/v1/projects/backend/load-balancers/",
+        }
+    ],
+}
+
+FRONTEND_PROJECT = {
+    "id": "frontend",
+    "name": "Frontend",
+    "url": "http://testserver/v1/projects/frontend/",
+    "stacks": [
+        {
+            "id": "frontend/dev",
+            "name": "Dev",
+            "url": "http://testserver/v1/projects/frontend/dev/",
+        },
+        {
+            "id": "frontend/staging",
+            "name": "Staging",
+            "url": "http://testserver/v1/projects/frontend/staging/",
+        },
+        {
+            "id": "frontend/prod",
+            "name": "Prod",
+            "url": "http://testserver/v1/projects/frontend/prod/",
+        },
+    ],
+}
+
+
 class TestProject(TestCase):
     def test_list_projects(self):
+        self.assertResponse("/v1/projects/", [BACKEND_PROJECT, FRONTEND_PROJECT])
+
+    def test_list_projects_num_queries(self):
+        # Projects, then the stacks of all projects
+        with self.assertNumQueries(2):
+            self.client.get("/v1/projects/")
+
+    def test_list_projects_format(self):
+        def with_format(project):
+            return {
+                **project,
+                "url": project["url"] + "?format=json",
+                "stacks": [
+                    {**stack, "url": stack["url"] + "?format=json"}
+                    for stack in project["stacks"]
+                ],
+            }
+
         self.assertResponse(
-            "/v1/projects/",
-            [
-                {
-                    "id": "backend",
-                    "name": "Backend",
-                    "url": "http://testserver/v1/projects/backend/",
-                    "stacks": [
-                        {
-                            "id": "backend/load-balancers",
-                            "name": "Load-Balancers",
-                            "url": "http://testserver/v1/projects/backend/load-balancers/",
-                        }
-                    ],
-                },
-                {
-                    "id": "frontend",
-                    "name": "Frontend",
-                    "stacks": [
-                        {
-                            "id": "frontend/dev",
-                            "name": "Dev",
-                            "url": "http://testserver/v1/projects/frontend/dev/",
-                        },
-                        {
-                            "id": "frontend/staging",
-                            "name": "Staging",
-                            "url": "http://testserver/v1/projects/frontend/staging/",
-                        },
-                        {
-                            "id": "frontend/prod",
-                            "name": "Prod",
-                            "url": "http://testserver/v1/projects/frontend/prod/",
-                        },
-                    ],
-                    "url": "http://testserver/v1/projects/frontend/",
-                },
-            ],
+            "/v1/projects/?format=json",
+            [with_format(BACKEND_PROJECT), with_format(FRONTEND_PROJECT)],
+        )
+        self.assertResponse(
+            "/v1/projects/backend/?format=json", with_format(BACKEND_PROJECT)
         )
 
     def test_create_project(self):
+        expected = {
+            "id": "hello-world",
+            "name": "Hello world",
+            "stacks": [],
+            "url": "http://testserver/v1/projects/hello-world/",
+        }
         response = self.client.post("/v1/projects/", {"name": "Hello world"})
         self.assertEqual(response.status_code, 201)
-        self.assertJSONEqual(
-            response.content,
-            {
-                "id": "hello-world",
-                "name": "Hello world",
-                "stacks": [],
-                "url": "http://testserver/v1/projects/hello-world/",
-            },
-        )
+        self.assertEqual(response.json(), expected)
         self.assertResponse(
-            "/v1/projects/",
-            [
-                {
-                    "id": "backend",
-                    "name": "Backend",
-                    "url": "http://testserver/v1/projects/backend/",
-                    "stacks": [
-                        {
-                            "id": "backend/load-balancers",
-                            "name": "Load-Balancers",
-                            "url": "http://testserver/v1/projects/backend/load-balancers/",
-                        }
-                    ],
-                },
-                {
-                    "id": "frontend",
-                    "name": "Frontend",
-                    "stacks": [
-                        {
-                            "id": "frontend/dev",
-                            "name": "Dev",
-                            "url": "http://testserver/v1/projects/frontend/dev/",
-                        },
-                        {
-                            "id": "frontend/staging",
-                            "name": "Staging",
-                            "url": "http://testserver/v1/projects/frontend/staging/",
-                        },
-                        {
-                            "id": "frontend/prod",
-                            "name": "Prod",
-                            "url": "http://testserver/v1/projects/frontend/prod/",
-                        },
-                    ],
-                    "url": "http://testserver/v1/projects/frontend/",
-                },
-                {
-                    "id": "hello-world",
-                    "name": "Hello world",
-                    "stacks": [],
-                    "url": "http://testserver/v1/projects/hello-world/",
-                },
-            ],
+            "/v1/projects/", [BACKEND_PROJECT, FRONTEND_PROJECT, expected]
         )
 
     def test_read_project(self):
-        self.assertResponse(
-            "/v1/projects/backend/",
-            {
-                "id": "backend",
-                "name": "Backend",
-                "stacks": [
-                    {
-                        "id": "backend/load-balancers",
-                        "name": "Load-Balancers",
-                        "url": "http://testserver/v1/projects/backend/load-balancers/",
-                    }
-                ],
-                "url": "http://testserver/v1/projects/backend/",
-            },
-        )
+        self.assertResponse("/v1/projects/backend/", BACKEND_PROJECT)
         response = self.client.get("/v1/projects/404/")
         self.assertEqual(response.status_code, 404)
 
     def test_update_project(self):
         self.client.put("/v1/projects/backend/", {"name": "Test"})
         self.assertResponse(
-            "/v1/projects/backend/",
-            {
-                "id": "backend",
-                "name": "Test",
-                "stacks": [
-                    {
-                        "id": "backend/load-balancers",
-                        "name": "Load-Balancers",
-                        "url": "http://testserver/v1/projects/backend/load-balancers/",
-                    }
-                ],
-                "url": "http://testserver/v1/projects/backend/",
-            },
+            "/v1/projects/backend/", {**BACKEND_PROJECT, "name": "Test"}
         )
 
     def test_destroy_project(self):
         self.client.delete("/v1/projects/frontend/")
-        self.assertResponse(
-            "/v1/projects/",
-            [
-                {
-                    "id": "backend",
-                    "name": "Backend",
-                    "url": "http://testserver/v1/projects/backend/",
-                    "stacks": [
-                        {
-                            "id": "backend/load-balancers",
-                            "name": "Load-Balancers",
-                            "url": "http://testserver/v1/projects/backend/load-balancers/",
-                        }
-                    ],
-                },
-            ],
-        )
+        self.assertResponse("/v1/projects/", [BACKEND_PROJECT])
 
 
 class TestStack(TestCase):
     def test_create_stack(self):
         response = self.client.post("/v1/projects/backend/", {"name": "Hello world"})
         self.assertEqual(response.status_code, 201, response.content)
-        self.assertJSONEqual(
-            response.content,
+        self.assertEqual(
+            response.json(),
             {
                 "id": "backend/hello-world",
                 "name": "Hello world",
@@ -254,8 +202,8 @@ class TestStack(TestCase):
             format="json",
         )
         self.assertEqual(response.status_code, 201, response.content)
-        self.assertJSONEqual(
-            response.content,
+        self.assertEqual(
+            response.json(),
             {
                 "id": "backend/test-with-outputs",
                 "name": "Test with outputs",
@@ -277,6 +225,61 @@ class TestStack(TestCase):
             },
         )
 
+    def test_create_stack_large_integer(self):
+        output = {
+            "value": 2**70,
+            "deprecated": None,
+            "warning": None,
+            "sensitive": False,
+        }
+        response = self.client.post(
+            "/v1/projects/backend/",
+            {"name": "Large", "outputs": {"big": {"value": 2**70}}},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(response.json()["outputs"], {"big": output})
+        self.assertResponse("/v1/projects/backend/large/outputs/", {"big": output})
+
+    def test_create_stack_invalid_outputs(self):
+        response = self.client.post(
+            "/v1/projects/backend/",
+            {
+                "name": "Invalid outputs",
+                "outputs": {
+                    "ok": {"value": "bar"},
+                    "not/a/slug": {"value": "bar"},
+                    "missing": {},
+                    "invalid": "bar",
+                    "types": {"value": 1, "deprecated": [], "sensitive": "maybe"},
+                },
+            },
+            format="json",
+        )
+        self.assertEqual(response.status_code, 400, response.content)
+        self.assertEqual(
+            response.json(),
+            {
+                "outputs": {
+                    "not/a/slug": [
+                        'Enter a valid "slug" consisting of letters, numbers, '
+                        "underscores or hyphens."
+                    ],
+                    "missing": {"value": ["This field is required."]},
+                    "invalid": {
+                        "non_field_errors": [
+                            "Invalid data. Expected a dictionary, but got str."
+                        ]
+                    },
+                    "types": {
+                        "deprecated": ["Not a valid string."],
+                        "sensitive": ["Must be a valid boolean."],
+                    },
+                }
+            },
+        )
+        self.assertFalse(Stack.objects.filter(name="Invalid outputs").exists())
+
     def test_read_stack(self):
         self.assertResponse(
             "/v1/projects/frontend/dev/",
@@ -306,6 +309,33 @@ class TestStack(TestCase):
         response = self.client.get("/v1/projects/backend/dev/")
         self.assertEqual(response.status_code, 404)
 
+    def test_read_stack_num_queries(self):
+        for used_by_id in (2, 3, 4):
+            UsedBy.objects.create(
+                stack_id=1, used_by_id=used_by_id, last_used_at=timezone.now()
+            )
+
+        # Stack and project, plain outputs, sensitive outputs, used by
+        with self.assertNumQueries(4):
+            self.client.get("/v1/projects/backend/load-balancers/")
+
+    def test_read_stack_used_by_limit(self):
+        stacks = Stack.objects.bulk_create(
+            Stack(name=f"Caller {i}", slug=f"caller-{i}", project_id=2)
+            for i in range(USED_BY_LIMIT + 1)
+        )
+        now = timezone.now()
+        UsedBy.objects.bulk_create(
+            UsedBy(stack_id=1, used_by=stack, last_used_at=now + timedelta(seconds=i))
+            for i, stack in enumerate(stacks)
+        )
+
+        response = self.client.get("/v1/projects/backend/load-balancers/")
+        used_by = response.json()["used_by"]
+        self.assertEqual(len(used_by), USED_BY_LIMIT)
+        self.assertEqual(used_by[0]["id"], f"frontend/caller-{USED_BY_LIMIT}")
+        self.assertEqual(used_by[-1]["id"], "frontend/caller-1")
+
     def test_update_stack(self):
         response = self.client.put(
             "/v1/projects/backend/load-balancers/", {"name": "Test"}
@@ -423,6 +453,22 @@ class TestOutput(TestCase):
         )
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.content, b"https://hello.eu-central-1.blabla")
+
+        Output.objects.create(stack_id=1, key="ports", value={"http": [80, 8080]})
+        response = self.client.get(
+            "/v1/projects/backend/load-balancers/outputs/ports/?format=raw"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'{"http":[80,8080]}')
+
+        Output.objects.create(stack_id=1, key="big", value={"id": [2**70, "é"]})
+        response = self.client.get(
+            "/v1/projects/backend/load-balancers/outputs/big/?format=raw"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.content, '{"id":[1180591620717411303424,"é"]}'.encode()
+        )
         response = self.client.get("/v1/projects/frontend/404/outputs/")
         self.assertEqual(response.status_code, 404)
         response = self.client.get("/v1/projects/frontend/404/outputs/hello/")
@@ -585,6 +631,35 @@ class TestOutput(TestCase):
             },
         )
 
+    def test_used_by_error(self):
+        with mock.patch.object(
+            UsedByRecorder, "upsert", side_effect=DatabaseError("broken")
+        ), self.assertLogs("app.views", "ERROR"):
+            response = self.client.get(
+                "/v1/projects/backend/load-balancers/outputs/",
+                HTTP_X_watson_STACK="frontend/dev",
+            )
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(USED_BY_FLUSH_INTERVAL=3600)
+    def test_used_by_coalesced(self):
+        recorder = UsedByRecorder()
+        first = timezone.now()
+        second = first + timedelta(days=1)
+
+        recorder.record(1, "frontend/dev", first)
+        recorder.record(1, "frontend/dev", second)
+        recorder.record(1, "frontend/dev", first)
+        recorder.record(1, "frontend/unknown", second)
+        recorder.record(1, "invalid", second)
+        self.assertFalse(UsedBy.objects.exists())
+
+        recorder.stop()
+        self.assertEqual(
+            list(UsedBy.objects.values_list("stack", "used_by", "last_used_at")),
+            [(1, 2, second)],
+        )
+
     @override_settings(WRAPPER="wrapper.ROT13Wrapper")
     def test_wrapped(self):
         response = self.client.post(
@@ -604,8 +679,8 @@ class TestOutput(TestCase):
             format="json",
         )
         self.assertEqual(response.status_code, 201, response.content)
-        self.assertJSONEqual(
-            response.content,
+        self.assertEqual(
+            response.json(),
             {
                 "id": "backend/wrapped",
                 "name": "Wrapped",
@@ -659,3 +734,105 @@ class TestOutput(TestCase):
             },
         )
         self.assertNotEqual(value, "test")
+        self.assertResponse(
+            "/v1/projects/backend/wrapped/outputs/",
+            {
+                "not_wrapped": {
+                    "value": "test",
+                    "deprecated": None,
+                    "warning": None,
+                    "sensitive": False,
+                },
+                "wrapped": {
+                    "value": "test",
+                    "deprecated": None,
+                    "warning": None,
+                    "sensitive": True,
+                },
+            },
+        )
+        self.assertResponse(
+            "/v1/projects/backend/wrapped/outputs/wrapped/",
+            {
+                "value": "test",
+                "deprecated": None,
+                "warning": None,
+                "sensitive": True,
+            },
+        )
+
+    @override_settings(WRAPPER="wrapper.ROT13Wrapper")
+    def test_wrapped_large_integer(self):
+        # Each value is encrypted, and then loaded, on its own
+        values = {
+            "big": {"ports": [80, 2**70, -(2**64)]},
+            "negative": -(2**63) - 1,
+        }
+        response = self.client.post(
+            "/v1/projects/backend/",
+            {
+                "name": "Wrapped",
+                "outputs": {
+                    k: {"value": v, "sensitive": True} for k, v in values.items()
+                },
+            },
+            format="json",
+        )
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertResponse(
+            "/v1/projects/backend/wrapped/outputs/",
+            {
+                k: {"value": v, "deprecated": None, "warning": None, "sensitive": True}
+                for k, v in values.items()
+            },
+        )
+
+    def test_wrapped_error(self):
+        with self.assertRaises(ValueError):
+            self.client.post(
+                "/v1/projects/backend/",
+                {
+                    "name": "Wrapped",
+                    "outputs": {"wrapped": {"value": "test", "sensitive": True}},
+                },
+                format="json",
+            )
+        self.assertFalse(Stack.objects.filter(slug="wrapped").exists())
+
+
+@override_settings(USED_BY_FLUSH_INTERVAL=0.01)
+class TestUsedByRecorder(TransactionTestCase):
+    fixtures = ["sample.json"]
+
+    def test_flush_in_background(self):
+        recorder = UsedByRecorder()
+        self.addCleanup(recorder.stop)
+        now = timezone.now()
+
+        recorder.record(1, "frontend/dev", now)
+        for _ in range(100):
+            if UsedBy.objects.exists():
+                break
+            time.sleep(0.01)
+        self.assertEqual(
+            list(UsedBy.objects.values_list("stack", "used_by", "last_used_at")),
+            [(1, 2, now)],
+        )
+
+    @override_settings(USED_BY_FLUSH_INTERVAL=3600)
+    def test_flush_error(self):
+        recorder = UsedByRecorder()
+        now = timezone.now()
+
+        recorder.record(404, "frontend/dev", now)
+        recorder.record(1, "frontend/dev", now)
+        with self.assertLogs("app.views", "ERROR") as logs:
+            recorder.stop()
+        self.assertEqual(
+            [r.getMessage() for r in logs.records],
+            ["Could not record that stack 2 read the outputs of stack 404"],
+        )
+        self.assertEqual(
+            list(UsedBy.objects.values_list("stack", "used_by", "last_used_at")),
+            [(1, 2, now)],
+        )
@@ -1,5 +1,14 @@
-from .models import Project, Stack, UsedBy
-from .serializers import ProjectSerializer, StackSerializer
+import atexit
+import json
+import logging
+import orjson
+import threading
+
+from .models import Output, Project, Stack, UsedBy
+from .serializers import ProjectSerializer, StackSerializer, reverse_url
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+from django.db.models import Prefetch
 from django.db.models.query import QuerySet
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
@@ -9,10 +18,13 @@ from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
 from rest_framework.settings import api_settings
 
+logger = logging.getLogger(__name__)
+
 
-class RawRenderer(renderers.JSONRenderer):
+class RawRenderer(renderers.BaseRenderer):
     media_type = "text/plain"
     format = "raw"
+    charset = "utf-8"
 
     def render(self, data, accepted_media_type=None, renderer_context=None):
         data = data["value"]
@@ -20,7 +32,137 @@ class RawRenderer(renderers.JSONRenderer):
         if isinstance(data, str):
             return data.encode()
 
-        return super().render(data, accepted_media_type, renderer_context)
+        try:
+            return orjson.dumps(data)
+        except orjson.JSONEncodeError:
+            # orjson only handles integers that fit in 64 bits
+            return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class UsedByRecorder:
+    """
+    Coalesces the reads of the outputs of a stack by other stacks and writes
+    them with a single upsert every `USED_BY_FLUSH_INTERVAL` seconds.
+
+    The writes are done by a background thread, started by the first read, and
+    the pending reads are flushed when the process exits. With an interval of 0
+    each read is written immediately.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def record(self, stack_pk, header, last_used_at):
+        interval = settings.USED_BY_FLUSH_INTERVAL
+        with self.lock:
+            key = (stack_pk, header)
+            if key not in self.pending or self.pending[key] < last_used_at:
+                self.pending[key] = last_used_at
+
+            if interval and self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run,
+                    args=(interval,),
+                    name="used-by-recorder",
+                    daemon=True,
+                )
+                self.thread.start()
+                atexit.register(self.stop)
+
+        if not interval:
+            self.flush()
+
+    def run(self, interval):
+        while not self.stopped.wait(interval):
+            # Like a request, do not keep a connection the database closed
+            close_old_connections()
+            self.flush()
+            close_old_connections()
+
+    def stop(self):
+        """Stop the background thread and write the reads still pending."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+
+        try:
+            self.write(self.resolve(pending))
+        except Exception:
+            logger.exception("Could not record the stacks reading outputs")
+
+    def resolve(self, pending):
+        callers = {}
+        used_by = {}
+        for (stack_pk, header), last_used_at in pending.items():
+            if header not in callers:
+                callers[header] = self.get_caller(header)
+            caller_pk = callers[header]
+            if caller_pk is None or caller_pk == stack_pk:
+                continue
+
+            key = (stack_pk, caller_pk)
+            if key not in used_by or used_by[key] < last_used_at:
+                used_by[key] = last_used_at
+
+        return [
+            UsedBy(stack_id=stack_pk, used_by_id=caller_pk, last_used_at=at)
+            for (stack_pk, caller_pk), at in used_by.items()
+        ]
+
+    def write(self, objs):
+        try:
+            self.upsert(objs)
+        except DatabaseError:
+            if len(objs) <= 1:
+                raise
+            # One bad row, like the one of a stack deleted since it was read,
+            # must not lose the others
+            for obj in objs:
+                try:
+                    self.upsert([obj])
+                except DatabaseError:
+                    logger.exception(
+                        "Could not record that stack %s read the outputs of stack %s",
+                        obj.used_by_id,
+                        obj.stack_id,
+                    )
+
+    def upsert(self, objs):
+        if not objs:
+            return
+
+        with transaction.atomic():
+            UsedBy.objects.bulk_create(
+                objs,
+                update_conflicts=True,
+                unique_fields=["stack", "used_by"],
+                update_fields=["last_used_at"],
+            )
+
+    def get_caller(self, header):
+        try:
+            project, slug = header.split("/", 1)
+        except ValueError:
+            return None
+
+        return (
+            Stack.objects.filter(project__slug=project, slug=slug)
+            .values_list("pk", flat=True)
+            .first()
+        )
+
+
+_used_by_recorder = UsedByRecorder()
 
 
 class StackViewSet(
@@ -39,15 +181,23 @@ class StackViewSet(
     def _update_used_by(self, request, obj):
         header = request.headers.get("x-watson-stack")
         if header is not None:
-            caller = Stack.objects.filter(full_path=header).first()
-            if caller is not None and caller.pk != obj.pk:
-                UsedBy.objects.update_or_create(
-                    stack=obj, used_by=caller, defaults={"last_used_at": timezone.now()}
-                )
+            # Only queued, the reads are written by the recorder in batches
+            _used_by_recorder.record(obj.pk, header, timezone.now())
+
+    def _get_stack_lean(self, slug):
+        # Only the primary key is needed to read the outputs, they are
+        # fetched on demand by Stack.outputs() and Stack.output()
+        queryset = (
+            self.get_queryset()
+            .select_related(None)
+            .prefetch_related(None)
+            .only("id", "slug", "project_id")
+        )
+        return get_object_or_404(queryset, slug=slug)
 
     @action(detail=True, url_path="outputs")
     def get_all_outputs(self, request, project, slug, format=None):
-        obj = get_object_or_404(self.get_queryset(), slug=slug)
+        obj = self._get_stack_lean(slug)
         self._update_used_by(request, obj)
         return Response(obj.outputs())
 
@@ -57,11 +207,11 @@ class StackViewSet(
         renderer_classes=[*api_settings.DEFAULT_RENDERER_CLASSES, RawRenderer],
     )
     def get_output(self, request, project, slug, key, format=None):
-        obj = get_object_or_404(self.get_queryset(), slug=slug)
+        obj = self._get_stack_lean(slug)
         self._update_used_by(request, obj)
         try:
-            value = obj.outputs()[key]
-        except KeyError:
+            value = obj.output(key)
+        except Output.DoesNotExist:
             raise NotFound(f"{key!r} is not present in the outputs.")
         return Response(value)
 
@@ -74,17 +224,65 @@ class ProjectViewSet(
     mixins.ListModelMixin,
     viewsets.GenericViewSet,
 ):
-    queryset = Project.objects.all()
+    queryset = Project.objects.prefetch_related(
+        Prefetch(
+            "stack_set",
+            # Only the fields rendered by ProjectSerializer.stacks are needed
+            queryset=(
+                Stack.objects.select_related(None)
+                .prefetch_related(None)
+                .only("id", "name", "slug", "project_id")
+            ),
+        )
+    )
     serializer_class = ProjectSerializer
     lookup_field = "slug"
 
+    def list(self, request, *args, **kwargs):
+        # The projects and their stacks are read as plain rows and rendered
+        # directly, without instantiating the models and their serializers
+        if self.format_kwarg is not None:
+            return super().list(request, *args, **kwargs)
+
+        projects = self.filter_queryset(self.get_queryset()).prefetch_related(None)
+        data = {}
+        for pk, name, slug in projects.values_list("id", "name", "slug"):
+            data[pk] = {
+                "id": slug,
+                "url": reverse_url("project-detail", {"slug": slug}, request),
+                "name": name,
+                "stacks": [],
+            }
+
+        stacks = (
+            Stack.objects.select_related(None)
+            .prefetch_related(None)
+            # Not a subquery, which would also see the projects created since
+            .filter(project_id__in=list(data))
+            .values_list("project_id", "name", "slug")
+        )
+        for project_pk, name, slug in stacks:
+            project = data[project_pk]
+            project["stacks"].append(
+                {
+                    "id": f"{project['id']}/{slug}",
+                    "url": reverse_url(
+                        "stack-detail",
+                        {"project": project["id"], "slug": slug},
+                        request,
+                    ),
+                    "name": name,
+                }
+            )
+
+        return Response(list(data.values()))
+
     def post(self, request, slug):
-        project = get_object_or_404(self.queryset, slug=slug)
+        project = get_object_or_404(Project.objects.all(), slug=slug)
         serializer = StackSerializer(data=request.data, context={"request": request})
         serializer.is_valid(raise_exception=True)
-        serializer.save(project_id=project.id)
+        serializer.save(project=project)
         data = serializer.data
-        data["id"] = f"{project.slug}/{serializer.instance.slug}"
 
         try:
             headers = {"Location": str(data[api_settings.URL_FIELD_NAME])}
@@ -1,19 +1,40 @@
+import base64
 import inspect
 import os
 
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from django.test import TestCase
-from wrapper import AWSKMSWrapper, FailWrapper, KMSWrapper
+from freezegun import freeze_time
+from unittest import mock
+from wrapper import (_CONFIG, AESWrapper, AWSKMSDataKeyWrapper, AWSKMSWrapper,
+                     DataKey, DataKeyCache, FailWrapper, KMSWrapper, LRUCache,
+                     ROT13Wrapper, _chunks, _Config)
+
+
+class FakeKMSClient:
+    """Mimics the calls to KMS made by AWSKMSWrapper"""
+
+    def encrypt(self, KeyId, Plaintext):
+        if not Plaintext:
+            raise ValueError('Plaintext must not be empty')
+        return {'CiphertextBlob': b'\x01' + Plaintext[::-1]}
+
+    def decrypt(self, KeyId, CiphertextBlob):
+        return {'Plaintext': CiphertextBlob[1:][::-1]}
+
+    def generate_data_key(self, KeyId, KeySpec):
+        key = AESGCM.generate_key(256)
+        return {'Plaintext': key, 'CiphertextBlob': b'\x01' + key[::-1]}
 
 
 class WrapperTestCase(TestCase):
     def test_protocol(self):
-        for cls in (FailWrapper, AWSKMSWrapper):
+        signature = inspect.signature(KMSWrapper.encrypt)
+        for cls in (FailWrapper, AESWrapper, AWSKMSWrapper,
+                    AWSKMSDataKeyWrapper):
             with self.subTest(cls=cls):
                 self.assertTrue(issubclass(cls, KMSWrapper))
-                self.assertEqual(
-                    inspect.signature(cls.encrypt),
-                    inspect.signature(KMSWrapper.encrypt),
-                )
+                self.assertEqual(inspect.signature(cls.encrypt), signature)
 
     def test_fail_wrapper(self):
         wrapper = FailWrapper()
@@ -22,6 +43,102 @@ class WrapperTestCase(TestCase):
         with self.assertRaises(ValueError):
             wrapper.decrypt(b'')
 
+    def test_rot13_wrapper(self):
+        wrapper = ROT13Wrapper()
+        msg = 'Hello, wörld!'.encode()
+        encrypted = wrapper.encrypt(msg)
+        self.assertEqual(encrypted, 'Uryyb, jöeyq!'.encode())
+        self.assertEqual(wrapper.decrypt(encrypted), msg)
+
+    def test_aes_wrapper(self):
+        with mock.patch.object(_CONFIG, 'aes_key', None):
+            with self.assertRaises(ValueError):
+                AESWrapper()
+
+        key = base64.b64encode(AESGCM.generate_key(256)).decode()
+        with mock.patch.object(_CONFIG, 'aes_key', key):
+            wrapper = AESWrapper()
+        for msg in (b'', b'test', b'hello'):
+            with self.subTest(msg=msg):
+                encrypted = wrapper.encrypt(msg)
+                self.assertNotEqual(msg, encrypted)
+                self.assertNotEqual(encrypted, wrapper.encrypt(msg))
+                decrypted = wrapper.decrypt(encrypted)
+                self.assertEqual(decrypted, msg)
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.set(b'a', b'1')
+        cache.set(b'b', b'2')
+        self.assertEqual(cache.get(b'a'), b'1')
+        cache.set(b'c', b'3')
+        self.assertIsNone(cache.get(b'b'))
+        self.assertEqual(cache.get(b'a'), b'1')
+        self.assertEqual(cache.get(b'c'), b'3')
+
+    def test_data_key_cache(self):
+        cache = DataKeyCache(max_age=10, max_messages=3, max_bytes=100)
+        self.assertIsNone(cache.get(1, 10))
+
+        with freeze_time('2022-07-02') as ft:
+            data_key = DataKey(AESGCM(AESGCM.generate_key(256)), b'')
+            cache.set(data_key, 1, 10)
+            self.assertIs(cache.get(2, 10), data_key)
+            self.assertIsNone(cache.get(1, 10))
+
+            cache.set(data_key, 0, 0)
+            self.assertIsNone(cache.get(1, 100))
+
+            data_key = DataKey(AESGCM(AESGCM.generate_key(256)), b'')
+            cache.set(data_key, 1, 10)
+            ft.tick(11)
+            self.assertIsNone(cache.get(1, 10))
+
+    def test_config(self):
+        env = {'AWSKMS_WRAPPER_DIRECT_SIZE': '8192',
+               'AWSKMS_WRAPPER_MAX_AGE': 'ten minutes'}
+        with mock.patch.dict(os.environ, env):
+            config = _Config()
+        self.assertEqual(config.direct_size, 4096)
+        self.assertEqual(config.max_messages, 10000)
+        with self.assertRaisesRegex(ValueError, 'AWSKMS_WRAPPER_MAX_AGE'):
+            config.max_age
+
+        with mock.patch('wrapper._CONFIG', config):
+            self.assertEqual(ROT13Wrapper().decrypt(b'grfg'), b'test')
+            with mock.patch.object(config, 'key_id', 'test'):
+                with self.assertRaisesRegex(ValueError,
+                                            'AWSKMS_WRAPPER_MAX_AGE'):
+                    AWSKMSWrapper()
+
+    def test_chunks(self):
+        self.assertEqual(
+            list(_chunks([1, 2, 3, 4, 5], 2)),
+            [[1, 2], [3, 4], [5]],
+        )
+        self.assertEqual(
+            list(_chunks([b'a', b'bb', b'ccc', b'dddddd', b'e'], 2, 4)),
+            [[b'a', b'bb'], [b'ccc'], [b'dddddd'], [b'e']],
+        )
+        self.assertEqual(list(_chunks([], 2)), [])
+
+    def test_aws_kms_direct(self):
+        client = FakeKMSClient()
+        with mock.patch.multiple(_CONFIG, key_id='test', direct_size=8):
+            wrapper = AWSKMSWrapper()
+            wrapper._client = client
+            msgs = [b'', b'test', b'a longer message']
+            encrypted = wrapper.encrypt_batch(msgs)
+            self.assertEqual([e[0] for e in encrypted], [0x02, 0x00, 0x02])
+
+            # A new wrapper, so the values are not read from its caches
+            wrapper = AWSKMSWrapper()
+            wrapper._client = client
+            self.assertEqual(wrapper.decrypt_batch(encrypted), msgs)
+
+            with self.assertRaises(ValueError):
+                wrapper.decrypt_batch([encrypted[1], b''])
+
     def test_aws_kms(self):
         if 'AWSKMS_WRAPPER_KEY_ID' not in os.environ:
             self.skipTest("AWSKMS_WRAPPER_KEY_ID must be set to test this wrapper")
@@ -33,3 +150,21 @@ class WrapperTestCase(TestCase):
                 self.assertNotEqual(msg, encrypted)
                 decrypted = wrapper.decrypt(encrypted)
                 self.assertEqual(decrypted, msg)
+
+        msgs = [b'', b'test', b'hello']
+        encrypted = wrapper.encrypt_batch(msgs)
+        self.assertEqual(wrapper.decrypt_batch(encrypted), msgs)
+        self.assertEqual(wrapper.decrypt(encrypted[1]), b'test')
+
+    def test_aws_kms_data_key(self):
+        if 'AWSKMS_WRAPPER_DATA_KEY' not in os.environ:
+            self.skipTest("AWSKMS_WRAPPER_DATA_KEY must be set to test this wrapper")
+
+        wrapper = AWSKMSDataKeyWrapper()
+        for msg in (b'', b'test', b'hello'):
+            with self.subTest(msg=msg):
+                encrypted = wrapper.encrypt(msg)
+                self.assertNotEqual(msg, encrypted)
+                self.assertNotEqual(encrypted, wrapper.encrypt(msg))
+                decrypted = wrapper.decrypt(encrypted)
+                self.assertEqual(decrypted, msg)
@@ -129,5 +129,19 @@ STATIC_URL = "static/"
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# Django REST framework
+# https://www.django-rest-framework.org/api-guide/settings/
+
+REST_FRAMEWORK = {
+    "DEFAULT_RENDERER_CLASSES": [
+        "app.renderers.ORJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ],
+}
+
 # Encryption support
 WRAPPER = os.environ.get("WATSON_WRAPPER", "wrapper.FailWrapper")
+
+# Number of seconds between two writes of the stacks reading outputs, they are
+# written immediately when set to 0
+USED_BY_FLUSH_INTERVAL = float(os.environ.get("WATSON_USED_BY_FLUSH_INTERVAL", 0.2))
@@ -1,54 +1,447 @@
+import abc
+import base64
 import boto3
-import codecs
+import functools
+import hashlib
 import os
+import threading
+import time
 
-from typing import Protocol, runtime_checkable
+from botocore.config import Config
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 
-@runtime_checkable
-class KMSWrapper(Protocol):
+def _parse(environ: Dict[str, str], name: str, type: Callable[[str], Any],
+           default: Any) -> Any:
+    """Parses the variable `name` of `environ` with `type`, if it is set"""
+    value = environ.get(name)
+    if value is None:
+        return default
+    try:
+        return type(value)
+    except ValueError:
+        raise ValueError(
+            f'{name} must be a valid {type.__name__}, got {value!r}'
+        ) from None
+
+
+def _env_property(name: str, type: Callable[[str], Any],
+                  default: Any) -> functools.cached_property:
+    return functools.cached_property(
+        lambda self: _parse(self.environ, name, type, default)
+    )
+
+
+class _Config:
+    """
+    The configuration of the wrappers, read from the environment when the
+    module is imported. The numbers are only parsed when first used so an
+    invalid one does not break the wrappers that do not need it.
+    """
+    pool_size = _env_property('AWSKMS_WRAPPER_POOL_SIZE', int, 50)
+    concurrency = _env_property('AWSKMS_WRAPPER_CONCURRENCY', int, 16)
+    cache_size = _env_property('AWSKMS_WRAPPER_CACHE_SIZE', int, 1024)
+    max_age = _env_property('AWSKMS_WRAPPER_MAX_AGE', float, 600)
+    max_messages = _env_property('AWSKMS_WRAPPER_MAX_MESSAGES', int, 10000)
+    max_bytes = _env_property('AWSKMS_WRAPPER_MAX_BYTES', int, 2**32)
+
+    def __init__(self) -> None:
+        self.environ = dict(os.environ)
+        self.key_id = self.environ.get('AWSKMS_WRAPPER_KEY_ID')
+        self.endpoint_url = self.environ.get('AWSKMS_ENDPOINT_URL')
+        self.data_key = self.environ.get('AWSKMS_WRAPPER_DATA_KEY')
+        self.aes_key = self.environ.get('AES_WRAPPER_KEY_B64')
+
+    @functools.cached_property
+    def direct_size(self) -> int:
+        # KMS cannot encrypt more than 4 KiB
+        size = _parse(self.environ, 'AWSKMS_WRAPPER_DIRECT_SIZE', int, 0)
+        return min(size, 4096)
+
+
+_CONFIG = _Config()
+
+
+def _chunks(items: List[Any], max_count: int,
+            max_bytes: Optional[int] = None) -> Iterator[List[Any]]:
+    """
+    Splits `items` in lists of at most `max_count` items and, when given,
+    `max_bytes` bytes. Items larger than `max_bytes` are yielded alone.
+    """
+    chunk = []
+    size = 0
+    for item in items:
+        if max_bytes is not None:
+            item_size = len(item)
+            if chunk and size + item_size > max_bytes:
+                yield chunk
+                chunk, size = [], 0
+            size += item_size
+        chunk.append(item)
+        if len(chunk) == max_count:
+            yield chunk
+            chunk, size = [], 0
+    if chunk:
+        yield chunk
+
+
+class KMSWrapper(abc.ABC):
+    __slots__ = ()
+
+    @abc.abstractmethod
     def encrypt(self, plaintext: bytes) -> bytes:
         ...
 
+    @abc.abstractmethod
     def decrypt(self, ciphertext: bytes) -> bytes:
         ...
 
 
-class FailWrapper:
+class FailWrapper(KMSWrapper):
+    message = 'No encryption wrapper has been configured'
+
+    __slots__ = ()
+
     def encrypt(self, plaintext: bytes) -> bytes:
-        raise ValueError('No encryption wrapper has been configured')
+        raise ValueError(self.message)
 
     def decrypt(self, ciphertext: bytes) -> bytes:
-        raise ValueError('No encryption wrapper has been configured')
+        raise ValueError(self.message)
 
 
-class ROT13Wrapper:
+class ROT13Wrapper(KMSWrapper):
     """ROT13Wrapper is used in the tests"""
+    __slots__ = ()
+    table = bytes.maketrans(
+        b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz',
+        b'NOPQRSTUVWXYZABCDEFGHIJKLMnopqrstuvwxyzabcdefghijklm',
+    )
+
     def encrypt(self, plaintext: bytes) -> bytes:
-        return codecs.encode(plaintext.decode(), 'rot_13').encode()
+        return plaintext.translate(self.table)
 
     def decrypt(self, ciphertext: bytes) -> bytes:
-        return codecs.encode(ciphertext.decode(), 'rot_13').encode()
+        return ciphertext.translate(self.table)
+
+
+class LRUCache:
+    """
+    LRUCache is a thread-safe mapping keeping at most `maxsize` items. Only a
+    16 bytes BLAKE2b digest of the keys is stored.
+    """
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.data: OrderedDict[bytes, Any] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: bytes) -> Any:
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        with self.lock:
+            try:
+                self.data.move_to_end(digest)
+            except KeyError:
+                return None
+            return self.data[digest]
+
+    def set(self, key: bytes, value: Any) -> None:
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        with self.lock:
+            self.data[digest] = value
+            self.data.move_to_end(digest)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+
+class DataKey:
+    def __init__(self, aead: AESGCM, header: bytes) -> None:
+        self.aead = aead
+        self.header = header
+        self.created_at = time.monotonic()
+        self.messages = 0
+        self.bytes = 0
+
+
+class DataKeyCache:
+    """
+    DataKeyCache keeps the last data key generated by KMS until it has been
+    used for more than `max_age` seconds, `max_messages` values or
+    `max_bytes` bytes.
+    """
+    def __init__(self, max_age: float, max_messages: int,
+                 max_bytes: int) -> None:
+        self.max_age = max_age
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.data_key: Optional[DataKey] = None
+        self.lock = threading.Lock()
+
+    def get(self, messages: int, size: int) -> Optional[DataKey]:
+        """Returns the cached key if it can encrypt `messages` more values"""
+        with self.lock:
+            data_key = self.data_key
+            if data_key is None:
+                return None
+            if (
+                time.monotonic() - data_key.created_at > self.max_age
+                or data_key.messages + messages > self.max_messages
+                or data_key.bytes + size > self.max_bytes
+            ):
+                self.data_key = None
+                return None
+            data_key.messages += messages
+            data_key.bytes += size
+            return data_key
+
+    def set(self, data_key: DataKey, messages: int, size: int) -> None:
+        with self.lock:
+            data_key.messages += messages
+            data_key.bytes += size
+            self.data_key = data_key
+
+
+# The first byte of a value tells how it has been encrypted. Ciphertexts
+# returned by KMS start with 0x01, values written before the version was
+# added are such ciphertexts.
+_DIRECT_VERSION = 0x00
+_ENVELOPE_VERSION = 0x02
+
+
+def _parse_raw(ciphertext: bytes) -> Tuple[bytes, Optional[bytes]]:
+    return ciphertext, None
+
+
+def _parse_direct(ciphertext: bytes) -> Tuple[bytes, Optional[bytes]]:
+    return ciphertext[1:], None
+
+
+def _parse_envelope(ciphertext: bytes) -> Tuple[bytes, Optional[bytes]]:
+    start = 3 + int.from_bytes(ciphertext[1:3], 'big')
+    return ciphertext[3:start], ciphertext[start:]
+
+
+# The parser of each version, they split a value into the blob to decrypt
+# with KMS, either the data key or the value itself, and the payload
+# encrypted locally with the data key
+_PARSERS = tuple(
+    {
+        _DIRECT_VERSION: _parse_direct,
+        _ENVELOPE_VERSION: _parse_envelope,
+    }.get(version, _parse_raw)
+    for version in range(256)
+)
+
 
+class AWSKMSWrapper(KMSWrapper):
+    """
+    AWSKMSWrapper encrypts the values locally with AES-GCM, using a data key
+    generated by AWS KMS that is stored encrypted in front of each value.
+
+    A data key is reused for AWSKMS_WRAPPER_MAX_AGE seconds,
+    AWSKMS_WRAPPER_MAX_MESSAGES values or AWSKMS_WRAPPER_MAX_BYTES bytes,
+    and the data keys decrypted by KMS are kept in a LRU cache of
+    AWSKMS_WRAPPER_CACHE_SIZE AES-GCM contexts.
+
+    Values of at most AWSKMS_WRAPPER_DIRECT_SIZE bytes are instead encrypted
+    by KMS itself, this is disabled by default.
+    """
+    direct_version = bytes([_DIRECT_VERSION])
+    envelope_version = bytes([_ENVELOPE_VERSION])
+    nonce_size = 12
+
+    __slots__ = (
+        'key_id', '_client', '_client_lock', 'decrypt_cache', 'aead_cache',
+        'data_keys', 'pool',
+    )
 
-class AWSKMSWrapper:
     def __init__(self) -> None:
-        self.key_id = os.environ['AWSKMS_WRAPPER_KEY_ID']
-        self.client = boto3.client(
-            'kms',
-            endpoint_url=os.environ.get('AWSKMS_ENDPOINT_URL'),
+        if _CONFIG.key_id is None:
+            raise ValueError('AWSKMS_WRAPPER_KEY_ID must be set')
+
+        self.key_id = _CONFIG.key_id
+        self._client = None
+        self._client_lock = threading.Lock()
+        self.decrypt_cache = LRUCache(_CONFIG.cache_size)
+        self.aead_cache = LRUCache(_CONFIG.cache_size)
+        self.data_keys = DataKeyCache(
+            max_age=_CONFIG.max_age,
+            max_messages=_CONFIG.max_messages,
+            max_bytes=_CONFIG.max_bytes,
         )
+        self.pool = ThreadPoolExecutor(max_workers=_CONFIG.concurrency)
+
+    @property
+    def client(self):
+        # Loading the KMS service model is slow, the client is only created
+        # when it is first needed
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = boto3.client(
+                        'kms',
+                        endpoint_url=_CONFIG.endpoint_url,
+                        config=Config(
+                            max_pool_connections=_CONFIG.pool_size,
+                            tcp_keepalive=True,
+                            retries={'max_attempts': 5, 'mode': 'adaptive'},
+                            connect_timeout=2,
+                            read_timeout=5,
+                        ),
+                    )
+        return self._client
 
     def encrypt(self, plaintext: bytes) -> bytes:
-        response = self.client.encrypt(
+        return self.encrypt_batch([plaintext])[0]
+
+    def decrypt(self, ciphertext: bytes) -> bytes:
+        return self.decrypt_batch([ciphertext])[0]
+
+    def encrypt_batch(self, plaintexts: List[bytes]) -> List[bytes]:
+        if not _CONFIG.direct_size:
+            return self._encrypt_envelope(plaintexts)
+
+        # KMS rejects empty plaintexts, they go through a data key
+        direct = [0 < len(p) <= _CONFIG.direct_size for p in plaintexts]
+        large = [p for p, small in zip(plaintexts, direct) if not small]
+        enveloped = iter(self._encrypt_envelope(large))
+        return [
+            self._encrypt_direct(p) if small else next(enveloped)
+            for p, small in zip(plaintexts, direct)
+        ]
+
+    def _encrypt_direct(self, plaintext: bytes) -> bytes:
+        ciphertext = self.client.encrypt(
             KeyId=self.key_id,
             Plaintext=plaintext,
-        )
-        return response['CiphertextBlob']
+        )['CiphertextBlob']
+        self.decrypt_cache.set(ciphertext, plaintext)
+        return self.direct_version + ciphertext
 
-    def decrypt(self, ciphertext: bytes) -> bytes:
-        response = self.client.decrypt(
+    def _encrypt_envelope(self, plaintexts: List[bytes]) -> List[bytes]:
+        # A data key never encrypts more than the limits of the cache, even
+        # for a single batch
+        ciphertexts = []
+        chunks = _chunks(plaintexts, _CONFIG.max_messages, _CONFIG.max_bytes)
+        for chunk in chunks:
+            size = sum(map(len, chunk))
+            data_key = self.data_keys.get(len(chunk), size)
+            if data_key is None:
+                data_key = self._generate_data_key()
+                self.data_keys.set(data_key, len(chunk), size)
+
+            for plaintext in chunk:
+                nonce = os.urandom(self.nonce_size)
+                ciphertexts.append(
+                    data_key.header
+                    + nonce
+                    + data_key.aead.encrypt(nonce, plaintext, None)
+                )
+        return ciphertexts
+
+    def decrypt_batch(self, ciphertexts: List[bytes]) -> List[bytes]:
+        if not all(ciphertexts):
+            raise ValueError('Cannot decrypt an empty ciphertext')
+        parsed = [_PARSERS[value[0]](value) for value in ciphertexts]
+
+        # The data keys are cached as ready to use AESGCM instances and the
+        # other blobs as their plaintext. KMS is called once per distinct
+        # blob missing from the caches, with at most AWSKMS_WRAPPER_CONCURRENCY
+        # concurrent requests.
+        decrypted: Dict[Tuple[bytes, bool], Any] = {}
+        missing = []
+        for blob, payload in parsed:
+            key = (blob, payload is not None)
+            if key in decrypted:
+                continue
+            cache = self.aead_cache if key[1] else self.decrypt_cache
+            decrypted[key] = cache.get(blob)
+            if decrypted[key] is None:
+                missing.append(key)
+
+        if len(missing) == 1:
+            decrypted[missing[0]] = self._decrypt(*missing[0])
+        else:
+            results = self.pool.map(lambda key: self._decrypt(*key), missing)
+            decrypted.update(zip(missing, results))
+
+        plaintexts = []
+        for blob, payload in parsed:
+            if payload is None:
+                plaintexts.append(decrypted[blob, False])
+                continue
+            aead = decrypted[blob, True]
+            nonce = payload[:self.nonce_size]
+            plaintexts.append(
+                aead.decrypt(nonce, payload[self.nonce_size:], None)
+            )
+        return plaintexts
+
+    def _generate_data_key(self) -> DataKey:
+        response = self.client.generate_data_key(
             KeyId=self.key_id,
-            CiphertextBlob=ciphertext,
+            KeySpec='AES_256',
+        )
+        encrypted_key = response['CiphertextBlob']
+        aead = AESGCM(response['Plaintext'])
+        self.aead_cache.set(encrypted_key, aead)
+        header = (
+            self.envelope_version
+            + len(encrypted_key).to_bytes(2, 'big')
+            + encrypted_key
         )
-        return response['Plaintext']
+        return DataKey(aead, header)
+
+    def _decrypt(self, blob: bytes, data_key: bool) -> Any:
+        plaintext = self.client.decrypt(
+            KeyId=self.key_id,
+            CiphertextBlob=blob,
+        )['Plaintext']
+        if data_key:
+            aead = AESGCM(plaintext)
+            self.aead_cache.set(blob, aead)
+            return aead
+
+        self.decrypt_cache.set(blob, plaintext)
+        return plaintext
+
+
+class AESWrapper(KMSWrapper):
+    """
+    AESWrapper encrypts locally with AES-GCM, using the base64 encoded 256-bit
+    key set in AES_WRAPPER_KEY_B64.
+    """
+    nonce_size = 12
+
+    __slots__ = ('aead',)
+
+    def __init__(self) -> None:
+        if _CONFIG.aes_key is None:
+            raise ValueError('AES_WRAPPER_KEY_B64 must be set')
+
+        self.aead = AESGCM(base64.b64decode(_CONFIG.aes_key))
+
+    def encrypt(self, plaintext: bytes) -> bytes:
+        nonce = os.urandom(self.nonce_size)
+        return nonce + self.aead.encrypt(nonce, plaintext, None)
+
+    def decrypt(self, ciphertext: bytes) -> bytes:
+        nonce = ciphertext[:self.nonce_size]
+        return self.aead.decrypt(nonce, ciphertext[self.nonce_size:], None)
+
+
+class AWSKMSDataKeyWrapper(AESWrapper):
+    """
+    AWSKMSDataKeyWrapper is an AESWrapper whose key has been encrypted by AWS
+    KMS (e.g. with `aws kms generate-data-key`). KMS is only called once, to
+    decrypt the data key.
+    """
+    __slots__ = ()
+
+    def __init__(self) -> None:
+        if _CONFIG.data_key is None:
+            raise ValueError('AWSKMS_WRAPPER_DATA_KEY must be set')
+
+        data_key = base64.b64decode(_CONFIG.data_key)
+        self.aead = AESGCM(AWSKMSWrapper().decrypt(data_key))